@@ -1,14 +1,18 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import email
 import email.utils
 import getpass
 import hashlib
 import imaplib
+import itertools
 import os
+import queue
 import re
 import sqlite3
 import sys
+import threading
 import time
 
 import tqdm
@@ -41,11 +45,8 @@ def __split_quoted(s):
         # then it is the ending quote, otherwise the quote
         # character is escaped by backslash, so we should
         # continue our search.
-        is_escaped = False
-        i = next_q - 1
-        while i >= 0 and rest[i] == ord("\\"):
-            i -= 1
-            is_escaped = not is_escaped
+        head = rest[:next_q]
+        is_escaped = (len(head) - len(head.rstrip(b"\\"))) % 2 == 1
         quoted += rest[0 : next_q + 1]
         rest = rest[next_q + 1 :]
         if not is_escaped:
@@ -71,11 +72,14 @@ def imapsplit(imapstring):
             rparenc = 1  # count of right parenthesis to match
             rpareni = 1  # position to examine
             while rparenc:  # Find the end of the group.
-                if workstr[rpareni] == ord(")"):  # end of a group
+                next_close = workstr.index(b")", rpareni)
+                next_open = workstr.find(b"(", rpareni, next_close)
+                if next_open == -1:  # end of a group
                     rparenc -= 1
-                elif workstr[rpareni] == ord("("):  # start of a group
+                    rpareni = next_close + 1
+                else:  # start of a group
                     rparenc += 1
-                rpareni += 1  # Move to next character.
+                    rpareni = next_open + 1
             parenlist = workstr[0:rpareni]
             workstr = workstr[rpareni:].lstrip()
             retval.append(parenlist)
@@ -118,31 +122,144 @@ def dequote(s):
     return s
 
 
+_MONTHS = "Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split(" ")
+_MON2NUM = {s.encode(): n + 1 for n, s in enumerate(_MONTHS)}
+
+
 # Same as imaplib.Internaldate2tuple without the parsing time zone.
 def Internaldate2tuple(resp):
-    InternalDate = re.compile(
-        rb'.*INTERNALDATE "'
-        rb"(?P<day>[ 0123][0-9])-(?P<mon>[A-Z][a-z][a-z])-(?P<year>[0-9][0-9][0-9][0-9])"
-        rb" (?P<hour>[0-9][0-9]):(?P<min>[0-9][0-9]):(?P<sec>[0-9][0-9])"
-        rb" \+0000"
-        rb'"'
-    )
+    # INTERNALDATE is fixed-width: "DD-Mon-YYYY HH:MM:SS +0000", where the day
+    # may be padded with a space. Parse the digits at their known offsets.
+    i = resp.find(b'INTERNALDATE "')
+    if i == -1:
+        return None
+    s = resp[i + 14 : i + 41]
+    if len(s) != 27 or s[20:] != b' +0000"':
+        return None
+    mon = _MON2NUM.get(s[3:6])
+    if mon is None:
+        return None
+    if (
+        s[0] not in b" 0123"
+        or s[2:3] != b"-"
+        or s[6:7] != b"-"
+        or s[11:12] != b" "
+        or s[14:15] != b":"
+        or s[17:18] != b":"
+        or not (s[1:2] + s[7:11] + s[12:14] + s[15:17] + s[18:20]).isdigit()
+    ):
+        return None
+
+    day = s[1] - 48 if s[0] == 0x20 else (s[0] - 48) * 10 + s[1] - 48
+    year = (s[7] - 48) * 1000 + (s[8] - 48) * 100 + (s[9] - 48) * 10 + s[10] - 48
+    hour = (s[12] - 48) * 10 + s[13] - 48
+    min = (s[15] - 48) * 10 + s[16] - 48
+    sec = (s[18] - 48) * 10 + s[19] - 48
+
+    return (year, mon, day, hour, min, sec, 0, 1, -1, 0)
+
+
+def compress_uids(uids):
+    """Formats sorted UIDs as an IMAP sequence set, e.g. [1, 2, 3, 5] => "1:3,5"."""
+
+    ranges = []
+    start = prev = None
+    for uid in uids:
+        if prev is not None and uid == prev + 1:
+            prev = uid
+            continue
+        if start is not None:
+            ranges.append(f"{start}:{prev}" if start != prev else str(start))
+        start = prev = uid
+    if start is not None:
+        ranges.append(f"{start}:{prev}" if start != prev else str(start))
+    return ",".join(ranges)
+
+
+def batched(iterable, n):
+    it = iter(iterable)
+    while batch := list(itertools.islice(it, n)):
+        yield batch
+
+
+def batched_by_size(uids, sizes, n, max_bytes):
+    """Like batched, but also ends a batch before its messages exceed max_bytes
+    in total. A message larger than max_bytes gets a batch of its own."""
 
-    Months = " Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split(" ")
-    Mon2num = {s.encode(): n + 1 for n, s in enumerate(Months[1:])}
+    batch = []
+    total = 0
+    for uid in uids:
+        size = sizes.get(uid, 0)
+        if batch and (len(batch) >= n or total + size > max_bytes):
+            yield batch
+            batch = []
+            total = 0
+        batch.append(uid)
+        total += size
+    if batch:
+        yield batch
 
-    mo = InternalDate.match(resp)
+
+_DATE_HEADER_RE = re.compile(rb"(?im)^Date:[ \t]*([^\r\n]+)")
+
+
+def get_date_header(data):
+    """Returns the raw value of the first Date header of a message, or None.
+
+    Only the header block is scanned, so this is much cheaper than
+    email.message_from_bytes for large messages."""
+
+    end = data.find(b"\r\n\r\n", 0, 65536)
+    if end == -1:
+        end = data.find(b"\n\n", 0, 65536)
+    headers = data[: end + 2] if end != -1 else data[:65536]
+    mo = _DATE_HEADER_RE.search(headers)
     if not mo:
         return None
+    return mo.group(1)
+
+
+_DATE_RE = re.compile(
+    rb"(?:\w+,\s*)?(\d{1,2})\s+(\w{3})\s+(\d{4})\s+(\d{2}):(\d{2}):(\d{2})\s*([+-])(\d{2})(\d{2})"
+)
+
+
+def parse_date(value):
+    """Parses a Date header value into a 10-tuple like email.utils.parsedate_tz.
+
+    The common "Day, DD Mon YYYY HH:MM:SS +ZZZZ" form is handled with a single
+    regex; anything else goes through parsedate_tz."""
+
+    mo = _DATE_RE.match(value)
+    if mo:
+        mon = _MON2NUM.get(mo.group(2))
+        if mon is not None:
+            day, _, year, hour, min, sec, sign, tzhour, tzmin = mo.groups()
+            tzoffset = int(tzhour) * 3600 + int(tzmin) * 60
+            if sign == b"-":
+                tzoffset = -tzoffset
+            return (
+                int(year),
+                mon,
+                int(day),
+                int(hour),
+                int(min),
+                int(sec),
+                0,
+                1,
+                -1,
+                tzoffset,
+            )
+    return email.utils.parsedate_tz(value.decode("ascii", "replace"))
 
-    day = int(mo.group("day"))
-    mon = Mon2num[mo.group("mon")]
-    year = int(mo.group("year"))
-    hour = int(mo.group("hour"))
-    min = int(mo.group("min"))
-    sec = int(mo.group("sec"))
 
-    return (year, mon, day, hour, min, sec, 0, 1, -1, 0)
+_STORE_FLAGS = (
+    os.O_WRONLY
+    | os.O_CREAT
+    | os.O_TRUNC
+    | getattr(os, "O_BINARY", 0)
+    | getattr(os, "O_CLOEXEC", 0)
+)
 
 
 class LocalFolder:
@@ -151,30 +268,37 @@ class LocalFolder:
         if not os.path.exists(self.path):
             os.makedirs(self.path)
 
-    def count(self):
-        return len(os.listdir(self.path))
-
-    def get_existing(self):
-        filenames = os.listdir(self.path)
-        return [int(f.split(".")[0]) for f in filenames]
-
     def store(self, uid, data, metadata):
         filename = os.path.join(self.path, f"{uid}.eml")
-        assert not os.path.exists(filename)
-        with open(filename, "wb") as f:
-            f.write(data)
-        t = 0
-        e = email.message_from_bytes(data)
-        date = e["Date"]
         time_tuple = None
+        date = get_date_header(data)
         if date is not None:
-            time_tuple = email.utils.parsedate_tz(str(date))
+            time_tuple = parse_date(date)
+        if time_tuple is None:
+            # Fall back to the full parser for unusual headers, e.g. folded.
+            date = email.message_from_bytes(data)["Date"]
+            if date is not None:
+                time_tuple = email.utils.parsedate_tz(str(date))
         if time_tuple is None:
             print(f"{filename} has no Date, will use INTERNAL_DATE", file=sys.stderr)
             time_tuple = Internaldate2tuple(metadata)
-
         t = email.utils.mktime_tz(time_tuple)
-        os.utime(filename, (t, t))
+
+        # Write to a temporary file and rename it, so that an interrupted
+        # download never leaves a partial message behind.
+        tmp_filename = os.path.join(self.path, f".{uid}.eml.tmp")
+        fd = os.open(tmp_filename, _STORE_FLAGS, 0o666)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view) :]
+            if os.utime in os.supports_fd:
+                os.utime(fd, (t, t))
+        finally:
+            os.close(fd)
+        if os.utime not in os.supports_fd:
+            os.utime(tmp_filename, (t, t))
+        os.replace(tmp_filename, filename)
 
 
 def connect(host, user, password):
@@ -184,6 +308,14 @@ def connect(host, user, password):
     return imap
 
 
+def disconnect(imaps):
+    for imap in imaps:
+        try:
+            imap.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
+
 def get_folders(imap):
     folders = []
     resp = imap.list()
@@ -194,7 +326,174 @@ def get_folders(imap):
     return folders
 
 
-def download(imap, destination, conn):
+def get_response_code(imap, code):
+    """Returns the integer value of a response code such as UIDNEXT from the
+    last command, or None if the server did not send it."""
+
+    typ, data = imap.response(code)
+    if not data or data[0] is None:
+        return None
+    return int(data[-1])
+
+
+def search_uids(imap, criteria):
+    resp = imap.uid("search", None, criteria)
+    assert resp[0] == "OK"
+    uids = list(map(int, resp[1][0].split()))
+    # Servers return the UIDs in ascending order, for which sort() is linear,
+    # and then the missing UIDs come out sorted as well.
+    uids.sort()
+    return uids
+
+
+_FETCH_UID_RE = re.compile(rb"\bUID (\d+)")
+_FETCH_SIZE_RE = re.compile(rb"\bRFC822\.SIZE (\d+)")
+
+
+def fetch_sizes(imap, uids):
+    """Returns a dict mapping the given UIDs to their RFC822.SIZE."""
+
+    sizes = {}
+    for chunk in batched(uids, 1000):
+        resp = imap.uid("FETCH", compress_uids(chunk), "(UID RFC822.SIZE)")
+        assert resp[0] == "OK"
+        for item in resp[1]:
+            if not isinstance(item, bytes):
+                continue
+            uid_mo = _FETCH_UID_RE.search(item)
+            size_mo = _FETCH_SIZE_RE.search(item)
+            if uid_mo and size_mo:
+                sizes[int(uid_mo.group(1))] = int(size_mo.group(1))
+    return sizes
+
+
+class FetchRefused(Exception):
+    """The server answered a FETCH with NO, e.g. [LIMIT] or [UNAVAILABLE]."""
+
+
+def fetch_batch(imap, uids):
+    """Fetches a batch of messages with a single UID FETCH command and returns
+    a list of (uid, data, metadata, sha1) tuples."""
+
+    resp = imap.uid(
+        "FETCH",
+        compress_uids(uids),
+        "(UID emailid threadid FLAGS INTERNALDATE BODY.PEEK[])",
+    )
+    if resp[0] != "OK":
+        raise FetchRefused(resp[1])
+    requested = set(uids)
+    messages = []
+    # imaplib returns (metadata, data) tuples interleaved with the closing b")".
+    # Servers may send the data items in any order, so UID can also end up in
+    # the bytes following the literal.
+    items = resp[1]
+    for i, item in enumerate(items):
+        if not isinstance(item, tuple):
+            continue
+        metadata, data = item
+        mo = _FETCH_UID_RE.search(metadata)
+        if mo is None and i + 1 < len(items) and isinstance(items[i + 1], bytes):
+            mo = _FETCH_UID_RE.search(items[i + 1])
+        assert mo is not None
+        uid = int(mo.group(1))
+        if uid in requested:
+            # Hash here, in the fetching thread, while the data is still hot;
+            # hashlib releases the GIL so the workers hash in parallel.
+            sha1 = hashlib.sha1(data, usedforsecurity=False).hexdigest()
+            messages.append((uid, data, metadata, sha1))
+    return messages
+
+
+class RateLimiter:
+    """Adaptive delay before IMAP requests. There is no delay while the server
+    is happy; each error doubles it, starting at min_delay, up to max_delay
+    and every recover_after consecutive successes halve it again."""
+
+    def __init__(self, min_delay=1, max_delay=60, recover_after=10):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.recover_after = recover_after
+        self.delay = 0
+        self.successes = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        delay = self.delay
+        if delay:
+            time.sleep(delay)
+
+    def on_success(self):
+        with self.lock:
+            self.successes += 1
+            if self.delay and self.successes >= self.recover_after:
+                self.delay = self.delay / 2 if self.delay >= 2 else 0
+                self.successes = 0
+
+    def on_error(self):
+        with self.lock:
+            self.delay = min(max(self.delay * 2, self.min_delay), self.max_delay)
+            self.successes = 0
+
+
+def fetch_worker(
+    imap, folder, local_folder, batches, results, stop, limiter, attempts=8
+):
+    """Selects the folder on its own connection, fetches the given batches and
+    stores the messages, putting each (batch, [(uid, metadata, sha1), ...])
+    result on the results queue once its files are written. A batch refused
+    by the server is retried after backing off, up to attempts times."""
+
+    try:
+        resp = imap.select(folder, readonly=True)
+        assert resp[0] == "OK"
+        for batch in batches:
+            if stop.is_set():
+                break
+            for attempt in range(1, attempts + 1):
+                limiter.wait()
+                try:
+                    messages = fetch_batch(imap, batch)
+                except FetchRefused as e:
+                    print(
+                        f"{dequote(folder).decode()} fetch refused: {e}",
+                        file=sys.stderr,
+                    )
+                    limiter.on_error()
+                    if attempt == attempts:
+                        raise
+                    continue
+                limiter.on_success()
+                break
+            for msg_uid, data, metadata, sha1 in messages:
+                local_folder.store(msg_uid, data, metadata)
+            # Only hand over what the inserts need, and release the message
+            # data before fetching the next batch.
+            results.put(
+                (
+                    batch,
+                    [
+                        (msg_uid, metadata, sha1)
+                        for msg_uid, data, metadata, sha1 in messages
+                    ],
+                )
+            )
+            del messages
+    except BaseException as e:
+        results.put((None, e))
+        raise
+
+
+def download(
+    imaps,
+    destination,
+    conn,
+    limiter,
+    batch_size=100,
+    batch_bytes=16 * 1024 * 1024,
+    checkpoint=100,
+):
+    imap = imaps[0]
     folders = get_folders(imap)
 
     for folder in folders:
@@ -204,47 +503,118 @@ def download(imap, destination, conn):
         resp = imap.select(folder, readonly=True)
         assert resp[0] == "OK"
         count = int(resp[1][0])
+        uidvalidity = get_response_code(imap, "UIDVALIDITY")
+        uidnext = get_response_code(imap, "UIDNEXT")
 
         local_folder = LocalFolder(os.path.join(destination, folder_unquoted))
-        existing_count = local_folder.count()
+        local_uids = {
+            row["uid"]
+            for row in conn.execute(
+                "select uid from emails where folder=?", (folder_unquoted,)
+            )
+        }
+        existing_count = len(local_uids)
 
         if count != existing_count:
             print(
                 f"{folder_unquoted} missing {count - existing_count}", file=sys.stderr
             )
 
-            resp = imap.uid("search", None, "ALL")
-            assert resp[0] == "OK"
-            remote_uids = set(map(int, resp[1][0].split()))
-
-            local_uids = set(local_folder.get_existing())
-            assert local_uids.issubset(remote_uids)
-
-            missing_uids = sorted(remote_uids - local_uids)
-            assert len(missing_uids) == count - existing_count
-
-            for msg_uid in tqdm.tqdm(missing_uids):
-                resp = imap.uid(
-                    "FETCH",
-                    str(msg_uid),
-                    "(emailid threadid FLAGS INTERNALDATE BODY.PEEK[])",
-                )
-                assert resp[0] == "OK"
-                metadata, data = resp[1][0]
-                local_folder.store(msg_uid, data, metadata)
-                args = (
-                    folder_unquoted,
-                    msg_uid,
-                    metadata.decode(),
-                    hashlib.sha1(data).hexdigest(),
-                )
-                cur = conn.cursor()
-                cur.execute(
-                    'insert into emails(folder, uid, metadata, created_at, sha1) values (?,?,?,datetime("now"),?)',
-                    args,
-                )
-                conn.commit()
-                time.sleep(1)
+            missing_uids = None
+            state = conn.execute(
+                "select uidvalidity, uidnext from folders where folder=?",
+                (folder_unquoted,),
+            ).fetchone()
+            if (
+                state is not None
+                and state["uidnext"] is not None
+                and uidvalidity is not None
+                and state["uidvalidity"] == uidvalidity
+            ):
+                # Only messages added since the last complete run can be
+                # missing. "n:*" always includes the highest UID, even if it is
+                # below n, so filter the result.
+                new_uids = search_uids(imap, f"UID {state['uidnext']}:*")
+                missing_uids = [
+                    uid
+                    for uid in new_uids
+                    if uid >= state["uidnext"] and uid not in local_uids
+                ]
+                if len(missing_uids) != count - existing_count:
+                    # Messages were also expunged; resynchronize fully.
+                    missing_uids = None
+
+            if missing_uids is None:
+                remote_uids = search_uids(imap, "ALL")
+                missing_uids = [uid for uid in remote_uids if uid not in local_uids]
+                # Equivalent to local_uids being a subset of remote_uids.
+                assert len(remote_uids) - len(missing_uids) == existing_count
+                assert len(missing_uids) == count - existing_count
+
+            # Batches are limited in bytes too, since each worker holds a whole
+            # batch in memory. They are sharded round-robin across the
+            # connections and each worker writes the files of its batches. The
+            # rows are inserted by this thread only, since the sqlite
+            # connection must not be shared between threads.
+            sizes = fetch_sizes(imap, missing_uids)
+            batches = list(
+                batched_by_size(missing_uids, sizes, batch_size, batch_bytes)
+            )
+            results = queue.Queue()
+            stop = threading.Event()
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(imaps)
+            ) as executor, tqdm.tqdm(total=len(missing_uids)) as progress:
+                for i, worker_imap in enumerate(imaps):
+                    executor.submit(
+                        fetch_worker,
+                        worker_imap,
+                        folder,
+                        local_folder,
+                        batches[i :: len(imaps)],
+                        results,
+                        stop,
+                        limiter,
+                    )
+                # Commit every checkpoint messages. On failure the uncommitted
+                # messages are rolled back and fetched again by the next run.
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    uncommitted = 0
+                    for _ in range(len(batches)):
+                        batch, messages = results.get()
+                        if isinstance(messages, BaseException):
+                            raise messages
+                        pending_rows = [
+                            (
+                                folder_unquoted,
+                                msg_uid,
+                                metadata.decode("ascii", errors="replace"),
+                                sha1,
+                            )
+                            for msg_uid, metadata, sha1 in messages
+                        ]
+                        conn.executemany(
+                            'insert or ignore into emails(folder, uid, metadata, created_at, sha1) values (?,?,?,datetime("now"),?)',
+                            pending_rows,
+                        )
+                        uncommitted += len(pending_rows)
+                        if uncommitted >= checkpoint:
+                            conn.execute("COMMIT")
+                            conn.execute("BEGIN IMMEDIATE")
+                            uncommitted = 0
+                        progress.update(len(batch))
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                finally:
+                    stop.set()
+
+        conn.execute(
+            "insert or replace into folders(folder, uidvalidity, uidnext) values (?,?,?)",
+            (folder_unquoted, uidvalidity, uidnext),
+        )
 
 
 def main():
@@ -252,21 +622,55 @@ def main():
     user = ""
     password = getpass.getpass()
     destination = ""
+    connections = 4
+    checkpoint = 100
 
-    conn = sqlite3.connect("storage.sqlite")
+    # Autocommit mode; download() manages its transactions explicitly.
+    conn = sqlite3.connect("storage.sqlite", isolation_level=None)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA temp_store=MEMORY")
     conn.execute(
         "create table if not exists emails(folder, uid, metadata, created_at, sha1)"
     )
+    try:
+        conn.execute(
+            "create unique index if not exists idx_emails_folder_uid on emails(folder, uid)"
+        )
+    except sqlite3.IntegrityError:
+        # Older versions could insert the same message twice.
+        print("Removing duplicate rows from emails", file=sys.stderr)
+        conn.execute(
+            "delete from emails where rowid not in (select min(rowid) from emails group by folder, uid)"
+        )
+        conn.execute(
+            "create unique index idx_emails_folder_uid on emails(folder, uid)"
+        )
+    conn.execute(
+        "create table if not exists folders(folder primary key, uidvalidity, uidnext)"
+    )
 
+    limiter = RateLimiter()
+    # Wait at least a minute before reconnecting after an abort, longer if the
+    # connection keeps failing right away.
+    reconnect = RateLimiter(min_delay=60, max_delay=600, recover_after=1)
     while True:
+        imaps = []
         try:
-            imap = connect(host, user, password)
-            download(imap, destination, conn)
+            reconnect.wait()
+            for _ in range(connections):
+                imaps.append(connect(host, user, password))
+            reconnect.on_success()
+            download(imaps, destination, conn, limiter, checkpoint=checkpoint)
             break
         except imaplib.IMAP4.abort as e:
             print(e)
-            time.sleep(60)
+            reconnect.on_error()
+        finally:
+            # Log out before reconnecting, to stay below the server's limit.
+            disconnect(imaps)
 
 
 if __name__ == "__main__":